@@ -1,10 +1,13 @@
 from passlib.context import CryptContext
-from jose import JWTError, jwt
+import jwt
+from cachetools import TTLCache
 from datetime import datetime, timedelta
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, load_only
+from sqlalchemy.dialects.postgresql import insert
 import os
+import time
 from dotenv import load_dotenv
 
 from .database import get_db, User as DBUser
@@ -16,57 +19,71 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY", "healthcare-secret-key-2024-super-secure-random-string")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 1440  # 24 hours
+SIGNING_KEY = SECRET_KEY.encode()
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Recently validated tokens -> (username, exp), so repeat requests skip decoding
+_token_cache = TTLCache(maxsize=10_000, ttl=60)
+
+# Argon2id for new hashes; bcrypt is verify-only (deprecated="auto"), so
+# existing bcrypt hashes still work and are upgraded on next login
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__rounds=2,
+    argon2__memory_cost=19456,
+    argon2__parallelism=1,
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
+# Verified against when the user doesn't exist, so unknown users cost the same
+# as Argon2 accounts. Limitation: accounts still on legacy bcrypt (cost 12)
+# verify noticeably slower, so until they are upgraded on their next successful
+# login, a wrong password for one of them is distinguishable from an unknown user
+DUMMY_HASH = pwd_context.hash("!")
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verify a password against its hash"""
-    return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
     """Hash a password"""
     return pwd_context.hash(password)
 
-def create_user(db: Session, user_data: UserCreate) -> DBUser:
-    """Create a new user in the database"""
-    # Check if username or email already exists
-    existing_user = db.query(DBUser).filter(
-        (DBUser.username == user_data.username) | 
-        (DBUser.email == user_data.email)
-    ).first()
-    
-    if existing_user:
-        if existing_user.username == user_data.username:
-            raise ValueError("Username already registered")
-        else:
-            raise ValueError("Email already registered")
-    
-    # Create new user
+def create_user(db: Session, user_data: UserCreate) -> int:
+    """Create a new user in the database and return its id"""
+    # Insert in one round-trip; a username/email collision inserts nothing
     hashed_password = get_password_hash(user_data.password)
-    db_user = DBUser(
+    stmt = insert(DBUser).values(
         username=user_data.username,
         email=user_data.email,
         full_name=user_data.full_name,
         hashed_password=hashed_password,
         created_at=datetime.utcnow(),
         is_active=True
-    )
+    ).on_conflict_do_nothing().returning(DBUser.id)
     
-    db.add(db_user)
+    user_id = db.execute(stmt).scalar()
     db.commit()
-    db.refresh(db_user)
     
-    return db_user
+    if user_id is None:
+        username_taken = db.query(DBUser.id).filter(
+            DBUser.username == user_data.username
+        ).first()
+        if username_taken:
+            raise ValueError("Username already registered")
+        else:
+            raise ValueError("Email already registered")
+    
+    return user_id
 
 def authenticate_user(db: Session, username: str, password: str):
     """Authenticate user credentials"""
     user = db.query(DBUser).filter(DBUser.username == username).first()
-    if not user:
-        return False
-    if not verify_password(password, user.hashed_password):
+    pw_hash = user.hashed_password if user else DUMMY_HASH
+    valid, new_hash = pwd_context.verify_and_update(password, pw_hash)
+    if not (user and valid):
         return False
+    if new_hash:
+        # Rehash with the current scheme/parameters
+        user.hashed_password = new_hash
+        db.commit()
     return user
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -78,7 +95,7 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, SIGNING_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
@@ -89,15 +106,31 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
         headers={"WWW-Authenticate": "Bearer"},
     )
     
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+    cached = _token_cache.get(token)
+    if cached and cached[1] > time.time():
+        username = cached[0]
+    else:
+        try:
+            payload = jwt.decode(
+                token, SIGNING_KEY, algorithms=[ALGORITHM], options={"require": ["exp", "sub"]}
+            )
+            username: str = payload.get("sub")
+            if username is None:
+                raise credentials_exception
+        except jwt.PyJWTError:
             raise credentials_exception
-    except JWTError:
-        raise credentials_exception
+        _token_cache[token] = (username, payload["exp"])
     
-    user = db.query(DBUser).filter(DBUser.username == username).first()
+    # Skip hashed_password; everything else is returned by /auth/me
+    user = db.query(DBUser).options(load_only(
+        DBUser.id,
+        DBUser.username,
+        DBUser.email,
+        DBUser.full_name,
+        DBUser.created_at,
+        DBUser.last_login,
+        DBUser.is_active
+    )).filter(DBUser.username == username).first()
     if user is None:
         raise credentials_exception
     
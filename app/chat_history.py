@@ -1,4 +1,3 @@
-import json
 from typing import List, Dict, Optional
 from sqlalchemy.orm import Session
 from datetime import datetime
@@ -10,15 +9,12 @@ class ChatHistoryManager:
     def save_message(self, db: Session, user_id: int, message: str, response: str, sources: List[Dict] = None):
         """Save a chat message to the database"""
         try:
-            # Convert sources to JSON string
-            sources_json = json.dumps(sources) if sources else None
-            
             # Create chat message record
             chat_message = ChatMessage(
                 user_id=user_id,
                 message=message,
                 response=response,
-                sources=sources_json,
+                sources=sources or None,
                 created_at=datetime.utcnow()
             )
             
@@ -35,20 +31,28 @@ class ChatHistoryManager:
     def get_user_history(self, db: Session, user_id: int, limit: int = 50) -> List[Dict]:
         """Get user's chat history"""
         try:
-            messages = db.query(ChatMessage).filter(
+            # Latest `limit` messages, returned in chronological order
+            latest = db.query(
+                ChatMessage.id,
+                ChatMessage.message,
+                ChatMessage.response,
+                ChatMessage.sources,
+                ChatMessage.created_at
+            ).filter(
                 ChatMessage.user_id == user_id
             ).order_by(
                 ChatMessage.created_at.desc()
-            ).limit(limit).all()
+            ).limit(limit).subquery()
+            
+            messages = db.query(latest).order_by(latest.c.created_at.asc()).all()
             
             history = []
-            for msg in reversed(messages):  # Reverse to show chronological order
-                sources = json.loads(msg.sources) if msg.sources else []
+            for msg in messages:
                 history.append({
                     'id': msg.id,
                     'message': msg.message,
                     'response': msg.response,
-                    'sources': sources,
+                    'sources': msg.sources or [],
                     'created_at': msg.created_at.isoformat(),
                 })
             
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+from typing import Optional, List, Dict, Any
 from datetime import datetime
 
 # User models
@@ -25,7 +25,7 @@ class ChatMessage(BaseModel):
     id: int
     message: str
     response: str
-    sources: Optional[str] = None
+    sources: Optional[List[Dict[str, Any]]] = None
     created_at: datetime
     
     class Config:
@@ -41,6 +41,7 @@ class Document(BaseModel):
     filename: str
     processed_at: datetime
     chunk_count: int
+    status: str
     is_active: bool
     
     class Config:
@@ -1,17 +1,51 @@
 import os
-import json
-import pickle
+import copy
+import asyncio
+import threading
 import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional
 from datetime import datetime
+from sqlalchemy import insert, text as sql_text
+from sqlalchemy.orm import Session
 import google.generativeai as genai
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 import PyPDF2
+import pypdfium2 as pdfium
 from dotenv import load_dotenv
 
+from .database import Document, DocumentChunk, EMBEDDING_DIM
+
 load_dotenv()
 
+# PDFium is not thread-safe, even across different documents, and extraction
+# runs on pool threads; a native crash would take down the worker, so every
+# pdfium call is serialized behind this lock
+_pdfium_lock = threading.Lock()
+
+# Threads for CPU-bound RAG work per process; each torch call also fans out
+# over its own intra-op threads, so keep this small
+RAG_POOL_SIZE = int(os.getenv("RAG_POOL_SIZE", "2"))
+
+# Rows per multi-row INSERT when storing document chunks
+CHUNK_INSERT_BATCH_SIZE = 500
+
+# Process-wide embedding model; loaded once and shared by forked workers
+_embedding_model = None
+
+def load_embedding_model() -> SentenceTransformer:
+    """Load the sentence transformer once per process"""
+    global _embedding_model
+    if _embedding_model is None:
+        print("Loading sentence transformer model...")
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        model = SentenceTransformer('all-MiniLM-L6-v2', device=device)
+        if device == 'cuda':
+            model = model.half()
+        _embedding_model = model
+    return _embedding_model
+
 class RAGSystem:
     """RAG system with Gemini AI and semantic search"""
     
@@ -24,17 +58,43 @@ class RAGSystem:
         genai.configure(api_key=self.api_key)
         self.model = genai.GenerativeModel('gemini-1.5-flash')
         
-        # Load embedding model
-        print("Loading sentence transformer model...")
-        self.embeddings_model = SentenceTransformer('all-MiniLM-L6-v2')
-        print("✅ Embedding model loaded successfully!")
+        # Load embedding model (reused if already preloaded in this process)
+        self.embeddings_model = load_embedding_model()
+        self.device = self.embeddings_model.device
+        self.embedding_dim = self.embeddings_model.get_sentence_embedding_dimension()
+        if self.embedding_dim != EMBEDDING_DIM:
+            raise ValueError(f"Embedding model outputs {self.embedding_dim} dims, database expects {EMBEDDING_DIM}")
+        
+        # Chunking tokenizes without truncation; the Rust tokenizer mutates its
+        # truncation state per call, so it can't be shared with encode() across threads
+        self._chunk_tokenizer = copy.deepcopy(self.embeddings_model.tokenizer)
+        
+        # Query path calls the tokenizer/transformer directly, skipping encode()'s DataLoader;
+        # it gets its own tokenizer for the same reason as chunking
+        self._query_tokenizer = copy.deepcopy(self.embeddings_model.tokenizer)
+        self._transformer = self.embeddings_model[0].auto_model.eval()
         
-        # Storage paths
-        self.storage_dir = "storage"
-        os.makedirs(self.storage_dir, exist_ok=True)
+        # Warm up so the first request doesn't pay the model/CUDA init cost
+        self.embeddings_model.encode(["warmup"], show_progress_bar=False)
+        print(f"✅ Embedding model loaded successfully on {self.device}!")
+        
+        # Worker pool for CPU-bound extraction/embedding, off the event loop
+        self._pool = ThreadPoolExecutor(max_workers=RAG_POOL_SIZE)
+        # Torch intra-op threads per process; gunicorn.conf.py splits the cores across workers
+        if os.getenv("TORCH_NUM_THREADS"):
+            torch.set_num_threads(int(os.getenv("TORCH_NUM_THREADS")))
+    
+    def close(self):
+        """Release the worker pool"""
+        self._pool.shutdown(wait=False)
     
     def extract_text_from_pdf(self, file_path: str) -> str:
         """Extract text from PDF file"""
+        try:
+            return self._extract_text_pdfium(file_path)
+        except Exception as e:
+            print(f"pdfium extraction failed, falling back to PyPDF2: {str(e)}")
+        
         try:
             text = ""
             with open(file_path, 'rb') as file:
@@ -46,174 +106,198 @@ class RAGSystem:
         except Exception as e:
             raise Exception(f"Error extracting text from PDF: {str(e)}")
     
-    def create_chunks(self, text: str, chunk_size: int = 1000, chunk_overlap: int = 200) -> List[str]:
-        """Create text chunks for processing"""
-        sentences = text.split('. ')
-        chunks = []
-        current_chunk = ""
+    def _extract_text_pdfium(self, file_path: str) -> str:
+        """Extract text from PDF file with the native PDFium parser"""
+        with _pdfium_lock:
+            pdf = pdfium.PdfDocument(file_path)
+            try:
+                pages = []
+                for i, page in enumerate(pdf):
+                    textpage = page.get_textpage()
+                    pages.append(f"[Page {i+1}]\n{textpage.get_text_range()}\n\n")
+                    textpage.close()
+                    page.close()
+                return "".join(pages)
+            finally:
+                pdf.close()
+    
+    def create_chunks(self, text: str, chunk_size: Optional[int] = None, chunk_overlap: int = 32) -> List[str]:
+        """Create overlapping chunks of at most chunk_size model tokens"""
+        tokenizer = self._chunk_tokenizer
+        if chunk_size is None:
+            # Leave room for the [CLS]/[SEP] tokens added at encode time
+            chunk_size = self.embeddings_model.max_seq_length - 2
+        step = max(chunk_size - chunk_overlap, 1)
         
-        for sentence in sentences:
-            if len(current_chunk) + len(sentence) <= chunk_size:
-                current_chunk += sentence + ". "
-            else:
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                current_chunk = sentence + ". "
+        # Slice the original text by token offsets so casing/spacing survive
+        offsets = tokenizer(
+            text, add_special_tokens=False, return_offsets_mapping=True, verbose=False
+        )['offset_mapping']
         
-        if current_chunk:
-            chunks.append(current_chunk.strip())
+        chunks = []
+        for start in range(0, len(offsets), step):
+            end = min(start + chunk_size, len(offsets))
+            chunk = text[offsets[start][0]:offsets[end - 1][1]].strip()
+            if chunk:
+                chunks.append(chunk)
+            if end == len(offsets):
+                break
         
         return chunks
     
-    async def process_document(self, file_path: str, user_id: int) -> str:
-        """Process a document and create embeddings"""
+    async def process_document(self, db: Session, document_id: int, file_path: str, user_id: int) -> Dict:
+        """Process a document and store its chunk embeddings"""
         try:
             print(f"Processing document: {os.path.basename(file_path)}")
             
+            loop = asyncio.get_running_loop()
+            
             # Extract text
-            text = self.extract_text_from_pdf(file_path)
+            text = await loop.run_in_executor(self._pool, self.extract_text_from_pdf, file_path)
             
             # Create chunks
-            chunks = self.create_chunks(text)
+            chunks = await loop.run_in_executor(self._pool, self.create_chunks, text)
             print(f"Created {len(chunks)} chunks")
             
             # Generate embeddings
             print("Generating embeddings...")
-            embeddings = self.embeddings_model.encode(chunks)
-            
-            # Create document ID
-            filename = os.path.basename(file_path)
-            doc_id = f"user_{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{filename}"
+            embeddings = await loop.run_in_executor(self._pool, self._embed_chunks, chunks)
             
-            # Save embeddings and metadata
-            embedding_data = {
-                'doc_id': doc_id,
-                'user_id': user_id,
-                'filename': filename,
-                'chunks': chunks,
-                'embeddings': embeddings.tolist(),
-                'processed_at': datetime.utcnow().isoformat(),
-                'chunk_count': len(chunks)
-            }
-            
-            # Save to file
-            embedding_file = os.path.join(self.storage_dir, f"{doc_id}.pkl")
-            with open(embedding_file, 'wb') as f:
-                pickle.dump(embedding_data, f)
-            
-            # Update user's document index
-            self._update_user_index(user_id, doc_id, embedding_data)
+            # Save chunks and embeddings
+            await loop.run_in_executor(
+                self._pool, self._store_chunks, db, document_id, user_id, chunks, embeddings
+            )
             
-            print(f"✅ Document processed successfully: {doc_id}")
-            return doc_id
+            print(f"✅ Document processed successfully: {document_id}")
+            return {'doc_id': document_id, 'chunk_count': len(chunks)}
             
         except Exception as e:
             raise Exception(f"Error processing document: {str(e)}")
     
-    def _update_user_index(self, user_id: int, doc_id: str, doc_data: dict):
-        """Update user's document index"""
-        index_file = os.path.join(self.storage_dir, f"user_{user_id}_index.json")
+    def _embed_chunks(self, chunks: List[str]) -> np.ndarray:
+        """Encode chunks into L2-normalized float32 embeddings"""
+        embeddings = self.embeddings_model.encode(
+            chunks, batch_size=128, show_progress_bar=False, convert_to_numpy=True
+        ).astype(np.float32)
         
-        # Load existing index or create new one
-        user_index = {}
-        if os.path.exists(index_file):
-            with open(index_file, 'r') as f:
-                user_index = json.load(f)
+        # L2-normalize once so stored vectors match the normalized query
+        if len(embeddings):
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings /= np.maximum(norms, 1e-12)
         
-        # Add document to index
-        user_index[doc_id] = {
-            'filename': doc_data['filename'],
-            'processed_at': doc_data['processed_at'],
-            'chunk_count': doc_data['chunk_count']
-        }
-        
-        # Save updated index
-        with open(index_file, 'w') as f:
-            json.dump(user_index, f, indent=2)
+        return embeddings
     
-    def get_user_documents(self, user_id: int) -> List[Dict]:
-        """Get list of user's processed documents"""
-        index_file = os.path.join(self.storage_dir, f"user_{user_id}_index.json")
+    def _encode_query(self, query: str) -> np.ndarray:
+        """Encode a single query into an L2-normalized float32 embedding"""
+        with torch.inference_mode():
+            batch = self._query_tokenizer(
+                query,
+                return_tensors='pt',
+                truncation=True,
+                max_length=self.embeddings_model.max_seq_length
+            ).to(self.device)
+            token_embeddings = self._transformer(**batch).last_hidden_state
+            
+            # Mean pooling over real tokens, as the model's Pooling layer does
+            mask = batch['attention_mask'].unsqueeze(-1).to(token_embeddings.dtype)
+            pooled = (token_embeddings * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+            query_embedding = torch.nn.functional.normalize(pooled.float(), dim=1)
         
-        if os.path.exists(index_file):
-            with open(index_file, 'r') as f:
-                return list(json.load(f).values())
-        return []
+        return query_embedding.cpu().numpy()[0]
     
-    def _load_user_embeddings(self, user_id: int) -> Dict:
-        """Load all embeddings for a user"""
-        index_file = os.path.join(self.storage_dir, f"user_{user_id}_index.json")
-        
-        if not os.path.exists(index_file):
-            return {'chunks': [], 'embeddings': [], 'metadata': []}
-        
-        with open(index_file, 'r') as f:
-            user_index = json.load(f)
+    def _store_chunks(self, db: Session, document_id: int, user_id: int, chunks: List[str], embeddings: np.ndarray):
+        """Save document chunks with their embeddings and mark the document processed"""
+        rows = [
+            {
+                'document_id': document_id,
+                'user_id': user_id,
+                'chunk_index': i,
+                'content': chunk,
+                'embedding': embedding
+            }
+            for i, (chunk, embedding) in enumerate(zip(chunks, embeddings.astype(np.float16)))
+        ]
         
-        all_chunks = []
-        all_embeddings = []
-        all_metadata = []
+        # Explicit multi-row INSERT ... VALUES per batch; psycopg 3 would otherwise
+        # run a Core executemany as one INSERT per row
+        for start in range(0, len(rows), CHUNK_INSERT_BATCH_SIZE):
+            db.execute(insert(DocumentChunk).values(rows[start:start + CHUNK_INSERT_BATCH_SIZE]))
         
-        for doc_id in user_index.keys():
-            embedding_file = os.path.join(self.storage_dir, f"{doc_id}.pkl")
-            if os.path.exists(embedding_file):
-                with open(embedding_file, 'rb') as f:
-                    doc_data = pickle.load(f)
-                
-                all_chunks.extend(doc_data['chunks'])
-                all_embeddings.extend(doc_data['embeddings'])
-                
-                for i, chunk in enumerate(doc_data['chunks']):
-                    all_metadata.append({
-                        'doc_id': doc_id,
-                        'filename': doc_data['filename'],
-                        'chunk_index': i
-                    })
+        # Commit together with the chunks so a processed document is never half-stored
+        document = db.query(Document).filter(Document.id == document_id).first()
+        document.status = "processed"
+        document.chunk_count = len(chunks)
+        document.processed_at = datetime.utcnow()
+        db.commit()
+    
+    def get_user_documents(self, db: Session, user_id: int) -> List[Dict]:
+        """Get list of user's processed documents"""
+        documents = db.query(Document).filter(
+            Document.user_id == user_id,
+            Document.status == "processed",
+            Document.is_active == True
+        ).order_by(Document.processed_at.desc()).all()
         
-        return {
-            'chunks': all_chunks,
-            'embeddings': np.array(all_embeddings) if all_embeddings else np.array([]),
-            'metadata': all_metadata
-        }
+        return [{
+            'id': doc.id,
+            'filename': doc.filename,
+            'processed_at': doc.processed_at.isoformat(),
+            'chunk_count': doc.chunk_count
+        } for doc in documents]
     
-    def semantic_search(self, query: str, user_id: int, top_k: int = 5) -> List[Dict]:
+    def semantic_search(self, db: Session, query: str, user_id: int, top_k: int = 5) -> List[Dict]:
         """Perform semantic search on user's documents"""
         try:
-            # Load user embeddings
-            user_data = self._load_user_embeddings(user_id)
-            
-            if len(user_data['embeddings']) == 0:
-                return []
-            
             # Generate query embedding
-            query_embedding = self.embeddings_model.encode([query])
+            query_embedding = self._encode_query(query)
             
-            # Calculate similarities
-            similarities = cosine_similarity(query_embedding, user_data['embeddings'])[0]
-            
-            # Get top results
-            top_indices = np.argsort(similarities)[::-1][:top_k]
+            # Nearest chunks by cosine distance, served by the HNSW index. The user
+            # filter is applied after the index scan, so keep scanning (pgvector >= 0.8)
+            # until enough of this user's chunks are found instead of stopping at ef_search
+            distance = DocumentChunk.embedding.cosine_distance(query_embedding)
+            db.execute(sql_text("SET LOCAL hnsw.ef_search = 100"))
+            db.execute(sql_text("SET LOCAL hnsw.iterative_scan = strict_order"))
+            rows = db.query(
+                DocumentChunk.content,
+                DocumentChunk.chunk_index,
+                DocumentChunk.document_id,
+                Document.filename,
+                distance.label('distance')
+            ).join(
+                Document, DocumentChunk.document_id == Document.id
+            ).filter(
+                DocumentChunk.user_id == user_id,
+                Document.is_active == True
+            ).order_by(distance).limit(top_k).all()
             
             results = []
-            for idx in top_indices:
-                if similarities[idx] > 0.1:  # Minimum similarity threshold
+            for row in rows:
+                similarity = 1 - row.distance
+                if similarity > 0.1:  # Minimum similarity threshold
                     results.append({
-                        'content': user_data['chunks'][idx],
-                        'metadata': user_data['metadata'][idx],
-                        'similarity': float(similarities[idx])
+                        'content': row.content,
+                        'metadata': {
+                            'doc_id': row.document_id,
+                            'filename': row.filename,
+                            'chunk_index': row.chunk_index
+                        },
+                        'similarity': float(similarity)
                     })
             
             return results
             
         except Exception as e:
+            db.rollback()
             print(f"Error in semantic search: {str(e)}")
             return []
     
-    async def get_answer(self, question: str, user_id: int, top_k: int = 5) -> Dict:
+    async def get_answer(self, db: Session, question: str, user_id: int, top_k: int = 5) -> Dict:
         """Get AI answer using RAG"""
         try:
             # Perform semantic search
-            relevant_chunks = self.semantic_search(question, user_id, top_k)
+            relevant_chunks = await asyncio.get_running_loop().run_in_executor(
+                self._pool, self.semantic_search, db, question, user_id, top_k
+            )
             
             if not relevant_chunks:
                 return {
@@ -248,8 +332,8 @@ class RAGSystem:
             "Important: This information is for educational purposes only. Always consult with healthcare professionals for medical advice, diagnosis, or treatment decisions."
             """
             
-            # Generate response
-            response = self.model.generate_content(
+            # Generate response; async API so the network wait holds no pool thread
+            response = await self.model.generate_content_async(
                 prompt,
                 generation_config=genai.types.GenerationConfig(
                     temperature=0.1,  # Lower temperature for medical accuracy
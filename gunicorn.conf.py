@@ -0,0 +1,42 @@
+import os
+import multiprocessing
+
+# Run with: gunicorn -c gunicorn.conf.py main:app
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", str(min(4, multiprocessing.cpu_count()))))
+
+# Split a budget of 80 connections (20 below Postgres's default
+# max_connections=100) across workers. Must be set before app.database
+# creates the engine; explicit DB_POOL_SIZE/DB_MAX_OVERFLOW win. Set the
+# worker count through WEB_CONCURRENCY (not -w) so this split follows it
+os.environ.setdefault("DB_POOL_SIZE", str(max(60 // workers, 2)))
+os.environ.setdefault("DB_MAX_OVERFLOW", str(max(20 // workers, 1)))
+
+# Give each worker its share of the cores for torch's intra-op threads
+os.environ.setdefault("TORCH_NUM_THREADS", str(max(multiprocessing.cpu_count() // workers, 1)))
+
+# torch.cuda.is_available() normally goes through cudaGetDeviceCount, which
+# breaks CUDA in forked children; the NVML check doesn't touch the runtime
+os.environ.setdefault("PYTORCH_NVML_BASED_CUDA_CHECK", "1")
+
+import torch
+
+from app.database import engine, init_db
+from app.rag_system import load_embedding_model
+
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = 120
+
+def on_starting(server):
+    """Prepare shared state in the master before workers are forked"""
+    # Create tables once so workers don't race on DDL
+    init_db()
+    # Inherited by the forked workers, whose lifespan then skips init_db
+    os.environ["DB_INITIALIZED"] = "1"
+    # Don't hand pooled connections to forked workers
+    engine.dispose()
+    # Workers inherit the loaded weights copy-on-write; CUDA can't survive
+    # a fork, so on GPU each worker loads its own model instead
+    if not torch.cuda.is_available():
+        load_embedding_model()
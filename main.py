@@ -1,9 +1,10 @@
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, BackgroundTasks, Request
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
 import uvicorn
+from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import List
 import os
@@ -11,13 +12,28 @@ from dotenv import load_dotenv
 
 from app.auth import authenticate_user, create_access_token, get_current_user, create_user
 from app.models import UserCreate, User, QuestionRequest
-from app.database import get_db, init_db
+from app.database import get_db, init_db, SessionLocal, Document as DBDocument
 from app.rag_system import RAGSystem
 from app.chat_history import ChatHistoryManager
 
 load_dotenv()
 
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(50 * 1024 * 1024)))  # bytes per request
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Heavy init runs per worker at startup, not at import. Under gunicorn the
+    # master already ran init_db before forking (see gunicorn.conf.py)
+    if not os.getenv("DB_INITIALIZED"):
+        init_db()
+    app.state.rag = RAGSystem()
+    print("🚀 Healthcare AI FastAPI started successfully!")
+    yield
+    app.state.rag.close()
+
 app = FastAPI(
+    lifespan=lifespan,
     title="Healthcare AI Assistant",
     description="FastAPI backend with authentication and RAG system",
     version="1.0.0"
@@ -32,18 +48,28 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Reject oversized uploads before the multipart body is parsed
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    if request.url.path == "/documents/upload":
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_SIZE:
+            return JSONResponse(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                content={"detail": f"Upload exceeds {MAX_UPLOAD_SIZE} bytes"}
+            )
+    return await call_next(request)
+
 # Initialize systems
-rag_system = RAGSystem()
 chat_manager = ChatHistoryManager()
 
+def get_rag_system(request: Request) -> RAGSystem:
+    """Get the RAG system created at startup"""
+    return request.app.state.rag
+
 # Serve static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-@app.on_event("startup")
-async def startup_event():
-    init_db()
-    print("🚀 Healthcare AI FastAPI started successfully!")
-
 @app.get("/", response_class=HTMLResponse)
 async def root():
     return FileResponse("static/index.html")
@@ -52,11 +78,11 @@ async def root():
 @app.post("/auth/register")
 async def register(user_data: UserCreate, db=Depends(get_db)):
     try:
-        user = create_user(db, user_data)
+        user_id = create_user(db, user_data)
         return {
             "success": True,
             "message": "User registered successfully",
-            "user_id": user.id
+            "user_id": user_id
         }
     except ValueError as e:
         raise HTTPException(
@@ -89,42 +115,119 @@ async def read_users_me(current_user: User = Depends(get_current_user)):
     return current_user
 
 # Document endpoints
+async def process_uploaded_document(rag_system: RAGSystem, document_id: int, file_path: str, user_id: int):
+    """Embed an uploaded document and record the outcome on its row"""
+    db = SessionLocal()
+    try:
+        await rag_system.process_document(db, document_id, file_path, user_id)
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Failed to process document {document_id}: {str(e)}")
+        db.query(DBDocument).filter(DBDocument.id == document_id).update({"status": "failed"})
+        db.commit()
+    finally:
+        db.close()
+
 @app.post("/documents/upload")
 async def upload_documents(
+    background_tasks: BackgroundTasks,
     files: List[UploadFile] = File(...),
     current_user: User = Depends(get_current_user),
-    db=Depends(get_db)
+    db=Depends(get_db),
+    rag_system: RAGSystem = Depends(get_rag_system)
 ):
+    saved_files = []
     try:
         os.makedirs("storage", exist_ok=True)
-        processed_files = []
+        
+        # Save and validate every file before creating any rows or tasks,
+        # so a rejected file can't leave earlier documents stuck as pending
         for file in files:
             if file.content_type != "application/pdf":
                 continue
             file_path = f"storage/{current_user.id}_{file.filename}"
-            content = await file.read()
+            saved_files.append((file.filename, file_path))
+            size = 0
             with open(file_path, "wb") as f:
-                f.write(content)
-            doc_id = await rag_system.process_document(file_path, current_user.id)
-            processed_files.append({
-                "filename": file.filename,
-                "document_id": doc_id,
-                "status": "processed"
-            })
-        return {
-            "success": True,
-            "message": f"Processed {len(processed_files)} documents",
-            "documents": processed_files
-        }
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > MAX_UPLOAD_SIZE:
+                        break
+                    f.write(chunk)
+            if size > MAX_UPLOAD_SIZE:
+                raise HTTPException(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    detail=f"{file.filename} exceeds {MAX_UPLOAD_SIZE} bytes"
+                )
+        
+        documents = [
+            DBDocument(
+                user_id=current_user.id,
+                filename=filename,
+                file_path=file_path,
+                status="pending"
+            )
+            for filename, file_path in saved_files
+        ]
+        db.add_all(documents)
+        db.flush()
+        queued_files = [{
+            "filename": document.filename,
+            "job_id": document.id,
+            "status": document.status
+        } for document in documents]
+        db.commit()
     except Exception as e:
+        db.rollback()
+        for _, file_path in saved_files:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        if isinstance(e, HTTPException):
+            raise
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error processing documents: {str(e)}"
+            detail=f"Error uploading documents: {str(e)}"
         )
+    
+    for (_, file_path), queued in zip(saved_files, queued_files):
+        background_tasks.add_task(process_uploaded_document, rag_system, queued["job_id"], file_path, current_user.id)
+    
+    return {
+        "success": True,
+        "message": f"Queued {len(queued_files)} documents for processing",
+        "documents": queued_files
+    }
+
+@app.get("/documents/status/{job_id}")
+async def document_status(
+    job_id: int,
+    current_user: User = Depends(get_current_user),
+    db=Depends(get_db)
+):
+    document = db.query(DBDocument).filter(
+        DBDocument.id == job_id,
+        DBDocument.user_id == current_user.id
+    ).first()
+    if document is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Document not found"
+        )
+    return {
+        "job_id": document.id,
+        "filename": document.filename,
+        "status": document.status,
+        "chunk_count": document.chunk_count,
+        "processed_at": document.processed_at.isoformat() if document.status == "processed" else None
+    }
 
 @app.get("/documents/list")
-async def list_user_documents(current_user: User = Depends(get_current_user)):
-    documents = rag_system.get_user_documents(current_user.id)
+async def list_user_documents(
+    current_user: User = Depends(get_current_user),
+    db=Depends(get_db),
+    rag_system: RAGSystem = Depends(get_rag_system)
+):
+    documents = rag_system.get_user_documents(db, current_user.id)
     return {"documents": documents}
 
 # Chat endpoints
@@ -132,10 +235,12 @@ async def list_user_documents(current_user: User = Depends(get_current_user)):
 async def ask_question(
     question_data: QuestionRequest,
     current_user: User = Depends(get_current_user),
-    db=Depends(get_db)
+    db=Depends(get_db),
+    rag_system: RAGSystem = Depends(get_rag_system)
 ):
     try:
         response = await rag_system.get_answer(
+            db=db,
             question=question_data.question,
             user_id=current_user.id,
             top_k=question_data.top_k or 5
@@ -194,8 +194,8 @@ async function handleFileUpload(event) {
         const result = await response.json();
         
         if (response.ok) {
-            addMessage('system', `✅ Successfully processed ${result.documents.length} documents!`);
-            loadDocuments();
+            addMessage('system', `⏳ Processing ${result.documents.length} documents...`);
+            result.documents.forEach(doc => pollDocumentStatus(doc.job_id, doc.filename));
         } else {
             addMessage('system', `❌ Error: ${result.detail}`);
         }
@@ -207,6 +207,29 @@ async function handleFileUpload(event) {
     }
 }
 
+async function pollDocumentStatus(jobId, filename) {
+    try {
+        const response = await fetch(`/documents/status/${jobId}`, {
+            headers: {
+                'Authorization': `Bearer ${authToken}`
+            }
+        });
+        
+        const result = await response.json();
+        
+        if (response.ok && result.status === 'pending') {
+            setTimeout(() => pollDocumentStatus(jobId, filename), 2000);
+        } else if (response.ok && result.status === 'processed') {
+            addMessage('system', `✅ Successfully processed ${filename}!`);
+            loadDocuments();
+        } else {
+            addMessage('system', `❌ Error processing ${filename}. Please try again.`);
+        }
+    } catch (error) {
+        console.error('Error checking document status:', error);
+    }
+}
+
 async function loadDocuments() {
     try {
         const response = await fetch('/documents/list', {